@@ -1,16 +1,139 @@
-#!/usr/bin/env python3.6
+#!/usr/bin/env python3
 
-import aiohttp
 import argparse
 import asyncio
-import asyncio_extras
-import json
+import datetime
+import functools
+import hashlib
+import httpx
 import logging
+import orjson
 import os
 import progressbar
+import random
+import sqlite3
 import sys
+import textwrap
+import time
+from contextlib import asynccontextmanager
+
+try:
+    import uvloop
+except ImportError:
+    # uvloop isn't available on Windows, default event loop is used there
+    uvloop = None
 
 GITHUB_DEFAULT_BASE_URL = "https://api.github.com"
+# maximum # of repositories returned by a contributions collection
+GQL_MAX_REPOSITORIES = 100
+GQL_PAGE_SIZE = 100
+CONTRIBUTIONS_WINDOW = datetime.timedelta(days=365)
+# contributions windows requested in one GraphQL query
+CONTRIBUTIONS_BATCH = 4
+# contributions windows aren't split any further than that
+MIN_WINDOW = datetime.timedelta(days=7)
+# response statuses which are always worth another attempt
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# time (in seconds) cached responses are served without revalidation
+STATS_CACHE_TTL = 60 * 60
+HISTORY_CACHE_TTL = 7 * 24 * 60 * 60
+# # of cached responses written between commits
+CACHE_COMMIT_EVERY = 50
+# slow requests are retried instead of holding a semaphore slot forever
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+KEEPALIVE_EXPIRY = 60
+
+
+def minify_gql(query):
+    # queries are sent on every request, whitespace is just extra bytes
+    return ' '.join(query.split())
+
+
+CONTRIBUTIONS_FRAGMENT = '''
+    fragment repositoryContributions on ContributionsCollection {
+        commitContributionsByRepository(maxRepositories: $limit) {
+            repository {
+                name
+                nameWithOwner
+                isEmpty
+                owner {
+                    login
+                }
+            }
+            contributions {
+                totalCount
+            }
+        }
+    }
+'''
+
+
+@functools.lru_cache()
+def user_contributions_query(windows, viewer=False):
+    # every window is an aliased collection with its own time range
+    params = ''.join(f', $since{i}: DateTime!, $until{i}: DateTime!'
+                     for i in range(windows))
+    aliases = '\n'.join(
+        f'w{i}: contributionsCollection(from: $since{i}, to: $until{i}) '
+        '{ ...repositoryContributions }' for i in range(windows))
+    # viewer is resolved from the token, no need to look up login
+    if viewer:
+        root = 'viewer'
+    else:
+        params = ', $login: String!' + params
+        root = 'user(login: $login)'
+    return minify_gql(f'''
+        query userContributions($limit: Int!{params}) {{
+            {root} {{
+                {aliases}
+            }}
+        }}
+    ''' + CONTRIBUTIONS_FRAGMENT)
+
+
+AUTHOR_HISTORY_QUERY = minify_gql('''
+    query authorHistory($owner: String!, $name: String!, $author: ID!,
+                        $first: Int!, $after: String) {
+        repository(owner: $owner, name: $name) {
+            defaultBranchRef {
+                target {
+                    ... on Commit {
+                        history(author: {id: $author}, first: $first,
+                                after: $after) {
+                            nodes {
+                                authoredDate
+                                additions
+                                deletions
+                            }
+                            pageInfo {
+                                hasNextPage
+                                endCursor
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+''')
+
+BOOTSTRAP_QUERY = minify_gql('''
+    query bootstrap($login: String!, $hasLogin: Boolean!) {
+        viewer @skip(if: $hasLogin) {
+            ...userInfo
+        }
+        user(login: $login) @include(if: $hasLogin) {
+            ...userInfo
+        }
+    }
+
+    fragment userInfo on User {
+        id
+        login
+        createdAt
+    }
+''')
 
 
 def arg_parser():
@@ -25,7 +148,8 @@ def arg_parser():
     parser.add_argument('-u', '--username', help='Contributor username',
                         default=None)
     parser.add_argument('-o', '--owner', dest='owners', action='append',
-                        help='Owners to check')
+                        help=('Only list repositories of given owners '
+                              '(default: all contributed repositories)'))
     parser.add_argument('-v', '--verbose',
                         help='Verbose mode (default: %(default)s)',
                         default=False, action='store_true')
@@ -36,10 +160,12 @@ def arg_parser():
                         help=('Maximum # of concurrent requests to GitHub '
                               '(default: %(default)s)'),
                         type=int, default=20)
-    parser.add_argument('-c', '--max-contributors',
-                        help=('Maximum # of concurrent requests to GitHub '
-                              'contributors endpoint (default: %(default)s)'),
-                        type=int, default=20)
+    parser.add_argument('--cache',
+                        help=('file to cache GitHub responses in '
+                              '(default: %(default)s)'),
+                        default=default_cache_path())
+    parser.add_argument('--no-cache', dest='cache', action='store_const',
+                        const=None, help='Do not cache GitHub responses')
     parser.add_argument('--out',
                         help=('output file with contributions '
                               '(default=stdout)'),
@@ -47,6 +173,11 @@ def arg_parser():
     return parser
 
 
+def default_cache_path():
+    cache_dir = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_dir, 'contributions.sqlite')
+
+
 def setup_logging(is_verbose):
     level = logging.DEBUG if is_verbose else logging.WARN
     log_format = ('%(asctime)s %(levelname)s %(filename)s:%(lineno)d '
@@ -54,235 +185,494 @@ def setup_logging(is_verbose):
     logging.basicConfig(format=log_format, level=level)
 
 
-def paginated(field, info_field='pageInfo'):
-    def paginated_decorator(func):
-        async def wrapper(*args, after=None, **kwargs):
-            while True:
-                page = await func(*args, **{**kwargs, **{'after': after}})
-                for it in page[field]:
-                    yield it
-
-                info = page[info_field]
-                if not info['hasNextPage']:
-                    return
-
-                after = info['endCursor']
-        return wrapper
-    return paginated_decorator
-
-
-class GHClient(aiohttp.ClientSession):
+class ResponseCache:
+
+    def __init__(self, path, salt='', max_age=HISTORY_CACHE_TTL):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # cache has names and stats of private repositories, so it's
+        # only readable by the owner
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+        os.chmod(path, 0o600)
+        self.db = sqlite3.connect(path)
+        self.uncommitted = 0
+        # writes are committed in batches, so they don't wait for disk
+        # flush on every response
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS graphql_responses (
+                key TEXT PRIMARY KEY,
+                body BLOB,
+                stored_at REAL
+            )
+        ''')
+        # rows older than any ttl would never be served again
+        self.db.execute('DELETE FROM graphql_responses WHERE stored_at < ?',
+                        (time.time() - max_age,))
+        # responses depend on who's asking, so keys are salted per token
+        self.salt = salt
+
+    def key(self, path, content):
+        parts = [self.salt.encode(), path.encode(), content]
+        return hashlib.sha256(b'\0'.join(parts)).hexdigest()
+
+    def get(self, key, ttl):
+        row = self.db.execute(
+            '''SELECT body FROM graphql_responses
+               WHERE key = ? AND stored_at > ?''',
+            (key, time.time() - ttl)).fetchone()
+        return row and row[0]
+
+    def put(self, key, body):
+        self.db.execute(
+            '''INSERT OR REPLACE INTO graphql_responses
+               (key, body, stored_at) VALUES (?, ?, ?)''',
+            (key, body, time.time()))
+        # commit now and then, so that an interrupted run keeps its cache
+        self.uncommitted += 1
+        if self.uncommitted >= CACHE_COMMIT_EVERY:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class GHClient(httpx.AsyncClient):
 
     def __init__(self, token, base_url,
-                 concur_max=10, contrib_max=5, contrib_delay=5, headers=None,
-                 **kwargs):
+                 concur_max=10, headers=None, max_retries=5, retry_delay=1,
+                 cache_path=None, **kwargs):
         self.__base_url = base_url
+        self.cache = None
+        if cache_path:
+            salt = hashlib.sha256(f'{base_url} {token}'.encode()).hexdigest()
+            self.cache = ResponseCache(cache_path, salt)
         self.semaphore = asyncio.Semaphore(concur_max)
-        self.contributors_sem = asyncio.Semaphore(contrib_max)
-        self.contributors_delay = contrib_delay
+        # cleared while rate limit is exhausted, so that all requests wait
+        # for the reset instead of being rejected one by one
+        self.rate_limit = asyncio.Event()
+        self.rate_limit.set()
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
         client_headers = {
             'Authorization': f'bearer {token}',
             'User-Agent': 'stats-script/velimir'
         }
         headers = {**(headers or {}), **client_headers}
-        super().__init__(headers=headers, **kwargs)
-
-    async def gql_request(self, query, **variables):
+        # all requests go to the same host, so they're multiplexed over
+        # a few HTTP/2 connections, pool is big enough for semaphore to
+        # be the only limit on concurrency
+        limits = httpx.Limits(max_connections=concur_max * 2,
+                              max_keepalive_connections=concur_max * 2,
+                              keepalive_expiry=KEEPALIVE_EXPIRY)
+        timeout = httpx.Timeout(None, connect=CONNECT_TIMEOUT,
+                                read=READ_TIMEOUT)
+        super().__init__(headers=headers, http2=True, limits=limits,
+                         timeout=timeout, **kwargs)
+
+    async def __aexit__(self, *args):
+        await super().__aexit__(*args)
+        if self.cache:
+            self.cache.close()
+
+    async def gql_request(self, query, cache_ttl=None, **variables):
         path = '/graphql'
-        payload = {'query': query, 'variables': variables}
-        async with self.request('post', path, json=payload) as resp:
-            res = await resp.json()
+        payload = orjson.dumps({'query': query, 'variables': variables})
+        cache_key = None
+        if self.cache and cache_ttl:
+            cache_key = self.cache.key(path, payload)
+            cached = self.cache.get(cache_key, cache_ttl)
+            if cached:
+                logging.debug('query %s served from cache', query)
+                return orjson.loads(cached)['data']
+
+        headers = {'Content-Type': 'application/json'}
+        async with self.request('post', path, content=payload,
+                                headers=headers) as resp:
+            # failed responses are left after retries are exhausted
+            if not resp.is_success:
+                logging.error('query %s response %s: %s', query,
+                              resp.status_code, resp.text)
+                raise RuntimeError(
+                    f'GQL request failed with status {resp.status_code}')
+            try:
+                res = orjson.loads(resp.content)
+            except orjson.JSONDecodeError as e:
+                raise RuntimeError(f'GQL response is not JSON: {e}') from e
             if not res.get('data', None):
-                text = await resp.text()
+                text = resp.text
                 logging.error('query %s response: %s', text, query)
                 reason = res.get('errors', text)
                 raise RuntimeError(f"GQL request failed: {reason}")
+            # responses with errors may be transient or partial, so only
+            # complete ones are cached
+            if cache_key and not res.get('errors'):
+                self.cache.put(cache_key, resp.content)
             return res['data']
 
-    @asyncio_extras.async_contextmanager
+    @asynccontextmanager
     async def request(self, method, path, **kwargs):
-        # TODO: wrap request into retry logic with exponential backoff
-        # see https://github.com/aio-libs/aiohttp/issues/850 for example
-        async with self.semaphore:
-            url = self.__base_url + path
-            logging.debug('%s: %s', method, url)
-            async with super().request(method, url, **kwargs) as resp:
-                yield resp
-
-    async def contributors(self, owner, repo):
-        async with self.contributors_sem:
-            contr = await self.__contributors(owner, repo)
-            return (owner, repo, contr)
-
-    async def __contributors(self, owner, repo, params=None):
+        url = self.__base_url + path
+
+        attempt = 0
         while True:
-            path = f'/repos/{owner}/{repo}/stats/contributors'
-            if self.__base_url != GITHUB_DEFAULT_BASE_URL:
-                path = '/v3' + path
-            async with self.request('get', path, params=None) as resp:
-                if resp.status == 202:
-                    logging.debug('contributor request for %s/%s initiated',
-                                  owner, repo)
-                    await asyncio.sleep(self.contributors_delay)
-                elif resp.status == 204:
-                    logging.debug('no contributions yet for %s/%s',
-                                  owner, repo)
-                    return []
-                elif resp.status == 403:
-                    logging.debug('no access to %s/%s', owner, repo)
-                    return []
-                elif resp.status == 200:
-                    return await resp.json()
+            await self.rate_limit.wait()
+            async with self.semaphore:
+                logging.debug('%s: %s', method, url)
+                try:
+                    resp = await super().request(method, url, **kwargs)
+                except httpx.TransportError as e:
+                    # timeouts, refused connections, reset HTTP/2 streams
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = self.__backoff(attempt)
+                    logging.debug('%s: %s failed (%r), retry in %.1fs',
+                                  method, url, e, delay)
                 else:
-                    text = await resp.text()
-                    logging.error('response %s: %s', resp.status, text)
-                    raise RuntimeError(
-                        f'unexpected response status {resp.status}')
-
-    @paginated('organizations')
-    async def organizations(self, user, after=None, limit=100):
-        query = '''
-            query userOrganizations($user: String!, $first: Int!,
-                                    $after: String) {
-                user(login: $user) {
-                    organizations(first: $first, after: $after) {
-                        edges {
-                            node {
-                                login
-                            }
-                        }
-                        pageInfo {
-                            hasNextPage
-                            endCursor
-                        }
-                    }
-                }
-            }
-        '''
-        res = await self.gql_request(query, user=user, after=after,
-                                     first=limit)
-        orgs = res['user']['organizations']
-        return {
-            'organizations': [edge['node'] for edge in orgs['edges']],
-            'pageInfo': orgs['pageInfo']
-        }
-
-    @paginated('repositories')
-    async def repositories(self, name, after=None, limit=100):
-        query = '''
-            query ownerRepositories($login: String!, $first: Int!,
-                                    $after: String) {
-                repositoryOwner(login: $login) {
-                    repositories(first: $first, after: $after) {
-                        edges {
-                            node {
-                                id
-                                name
-                                nameWithOwner
-                            }
-                        }
-                        pageInfo {
-                            hasNextPage
-                            endCursor
-                        }
-                    }
-                }
-            }
-        '''
-        res = await self.gql_request(query, login=name, after=after,
-                                     first=limit)
-        repos = res['repositoryOwner']['repositories']
-
-        def shape_node(node):
-            owner, _ = node['nameWithOwner'].split('/')
-            node['owner'] = owner
+                    logging.debug('%s: %s status: %s, encoding: %s', method,
+                                  url, resp.status_code,
+                                  resp.headers.get('Content-Encoding'))
+                    delay = self.__retry_delay(resp, attempt)
+                    if delay is None or attempt >= self.max_retries:
+                        yield resp
+                        return
+                    logging.debug('%s: %s responded with %s, retry in %.1fs',
+                                  method, url, resp.status_code, delay)
+            # sleep outside of the semaphore to let other requests proceed
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def __retry_delay(self, resp, attempt):
+        retry_after = resp.headers.get('Retry-After')
+        remaining = resp.headers.get('X-RateLimit-Remaining')
+        reset = resp.headers.get('X-RateLimit-Reset')
+        reset_delay = None
+        if remaining == '0' and reset:
+            reset_delay = max(int(reset) - time.time(), 0) + 1
+            self.__pause(reset_delay)
+
+        # secondary rate limits may come with any status, even 200
+        if retry_after:
+            return float(retry_after)
+
+        # 403 is returned for inaccessible resources as well and GraphQL
+        # reports exhausted rate limit with 200, so both are only retried
+        # if GitHub says there is no quota left
+        rate_limited = remaining == '0' and \
+            (resp.status_code == 403 or rate_limited_response(resp))
+        if resp.status_code not in RETRY_STATUSES and not rate_limited:
+            return None
+
+        if reset_delay is not None:
+            return reset_delay
+        return self.__backoff(attempt)
+
+    def __backoff(self, attempt):
+        return self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def __pause(self, delay):
+        if self.rate_limit.is_set():
+            logging.warning('rate limit is exhausted, pause for %.0fs', delay)
+            self.rate_limit.clear()
+            loop = asyncio.get_event_loop()
+            loop.call_later(delay, self.rate_limit.set)
+
+    async def author_stats(self, owner, repo, author):
+        # only author's commits are fetched and folded into weekly stats
+        # as they arrive, so payload doesn't depend on repository size
+        weeks = {}
+        after = None
+        while True:
+            res = await self.gql_request(AUTHOR_HISTORY_QUERY,
+                                         cache_ttl=STATS_CACHE_TTL,
+                                         owner=owner, name=repo,
+                                         author=author['id'],
+                                         first=GQL_PAGE_SIZE, after=after)
+            branch = (res['repository'] or {}).get('defaultBranchRef')
+            if not branch:
+                logging.debug('no history for %s/%s', owner, repo)
+                return (owner, repo, None)
+
+            history = branch['target']['history']
+            for commit in history['nodes']:
+                week = week_start(parse_gql_datetime(commit['authoredDate']))
+                stats = weeks.setdefault(week, {'a': 0, 'd': 0, 'c': 0})
+                stats['a'] += commit['additions']
+                stats['d'] += commit['deletions']
+                stats['c'] += 1
+
+            info = history['pageInfo']
+            if not info['hasNextPage']:
+                break
+            after = info['endCursor']
+
+        if not weeks:
+            return (owner, repo, None)
+
+        # same shape as /stats/contributors entries
+        return (owner, repo, {
+            'author': {'login': author['login']},
+            'total': sum(stats['c'] for stats in weeks.values()),
+            'weeks': [{'w': int(week.timestamp()), **weeks[week]}
+                      for week in sorted(weeks)]
+        })
+
+    async def user_contributions(self, login, windows):
+        # login is None for the viewer
+        # contributions in the past are unlikely to change
+        recent = max(until for _, until in windows) > \
+            datetime.datetime.now(datetime.timezone.utc) - \
+            datetime.timedelta(days=1)
+        ttl = STATS_CACHE_TTL if recent else HISTORY_CACHE_TTL
+        variables = {}
+        for i, (since, until) in enumerate(windows):
+            variables[f'since{i}'] = gql_datetime(since)
+            variables[f'until{i}'] = gql_datetime(until)
+        if login:
+            variables['login'] = login
+        query = user_contributions_query(len(windows), viewer=not login)
+        res = await self.gql_request(query, cache_ttl=ttl,
+                                     limit=GQL_MAX_REPOSITORIES, **variables)
+        contributor = res['user'] if login else res['viewer']
+
+        def shape_node(contribution):
+            node = contribution['repository']
+            node['owner'] = node['owner']['login']
+            node['commits'] = contribution['contributions']['totalCount']
             return node
 
-        return {
-            'repositories': [shape_node(edge['node'])
-                             for edge in repos['edges']],
-            'pageInfo': repos['pageInfo']
-        }
+        return [[shape_node(contribution) for contribution
+                 in contributor[f'w{i}']['commitContributionsByRepository']]
+                for i in range(len(windows))]
 
-    async def viewer(self):
-        query = '''
-            query viewerLogin {
-                viewer {
-                    login
-                }
-            }
-        '''
-        rs = await self.gql_request(query)
-        return rs['viewer']
+    async def bootstrap(self, login=None):
+        # resolves given user or the viewer if no login is given
+        rs = await self.gql_request(BOOTSTRAP_QUERY,
+                                    cache_ttl=HISTORY_CACHE_TTL,
+                                    login=login or '', hasLogin=bool(login))
+        user = rs['user'] if login else rs['viewer']
+        if not user:
+            raise RuntimeError(f'user {login} is not found')
+        return user
 
 
-async def affected_owners(gh, username, organizations):
-    if organizations:
-        for org in organizations:
-            yield org
+def rate_limited_response(resp):
+    try:
+        res = orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
+        return False
+    if not isinstance(res, dict):
+        return False
+    errors = res.get('errors') or []
+    return not res.get('data') or \
+        any(error.get('type') == 'RATE_LIMITED' for error in errors)
 
-    else:
-        async for org in gh.organizations(username):
-            yield org['login']
 
-    yield username
+def gql_datetime(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
-def task_iterator(progress_enabled, max_value):
+def parse_gql_datetime(value):
+    # git timestamps keep author's timezone offset
+    dt = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return dt.astimezone(datetime.timezone.utc)
+
+
+def week_start(dt):
+    # weeks start on Sunday, same as in GitHub statistics
+    day = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - datetime.timedelta(days=(day.weekday() + 1) % 7)
+
+
+def contribution_windows(since, until):
+    # contributions collection can't span more than a year, windows are
+    # anchored at since, so that past ones are the same between runs
+    while since < until:
+        end = min(since + CONTRIBUTIONS_WINDOW, until)
+        yield since, end
+        since = end
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+async def contributed_repositories(gh, login, windows):
+    repos = []
+    truncated = []
+    collections = await gh.user_contributions(login, windows)
+    for (since, until), collection in zip(windows, collections):
+        if len(collection) < GQL_MAX_REPOSITORIES or \
+                until - since <= MIN_WINDOW:
+            repos.extend(collection)
+        else:
+            # collection is truncated, split time window to get the rest
+            middle = since + (until - since) / 2
+            truncated += [(since, middle), (middle, until)]
+
+    if truncated:
+        rest = await asyncio.gather(
+            *[contributed_repositories(gh, login, batch)
+              for batch in chunks(truncated, CONTRIBUTIONS_BATCH)])
+        repos.extend(repo for batch in rest for repo in batch)
+    return repos
+
+
+def drain_queue(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return [item for item in items if item is not None]
+
+
+def progress_bar(progress_enabled):
     if progress_enabled:
+        # total # of repositories isn't known until discovery is finished
         return progressbar.ProgressBar(
-            max_value=max_value,
-            widgets=[progressbar.widgets.SimpleProgress(), ' ',
-                     progressbar.widgets.ETA(), ' ',
-                     progressbar.widgets.Percentage(), ' ',
-                     progressbar.widgets.Bar()])
-    return iter
+            max_value=progressbar.UnknownLength,
+            widgets=[progressbar.widgets.Counter(), ' ',
+                     progressbar.widgets.Timer(), ' ',
+                     progressbar.widgets.AnimatedMarker()])
+    return progressbar.NullBar()
 
 
 async def list_contributions(token, base_url, username=None, owners=None,
-                             max_concurrency=20, max_contributions=20,
-                             pbar_enabled=True):
+                             max_concurrency=20, pbar_enabled=True,
+                             cache_path=None):
     async with GHClient(token, base_url, concur_max=max_concurrency,
-                        contrib_max=max_contributions) as gh:
-        if not username:
-            user = await gh.viewer()
-            username = user['login']
-
-        tasks = []
-        async for owner in affected_owners(gh, username, owners):
-            async for repo in gh.repositories(owner):
-                coro = gh.contributors(repo['owner'], repo['name'])
-                task = asyncio.ensure_future(coro)
-                tasks.append(task)
-
-        user_stats = []
-        async_iter = asyncio.as_completed(tasks)
-        do_it = task_iterator(pbar_enabled, len(tasks))
-        for task in do_it(async_iter):
+                        cache_path=cache_path) as gh:
+        user = await gh.bootstrap(username)
+        login = user['login'] if username else None
+
+        owners = {owner.lower() for owner in owners or []}
+        since = parse_gql_datetime(user['createdAt'])
+        # current window is rounded down to the hour, so that its
+        # cached response can be reused for STATS_CACHE_TTL
+        now = datetime.datetime.now(datetime.timezone.utc)
+        until = now.replace(minute=0, second=0, microsecond=0)
+        if until <= since:
+            # account is created within the current hour
+            until = now
+        # bounded, so that discovery doesn't get too far ahead of consumer
+        queue = asyncio.Queue(maxsize=max_concurrency * 2)
+        discovered = set()
+
+        async def discover(windows):
+            # stats are requested as soon as a batch is resolved
+            for repo in await contributed_repositories(gh, login, windows):
+                name = repo['nameWithOwner']
+                if owners and repo['owner'].lower() not in owners or \
+                        repo['isEmpty'] or name in discovered:
+                    continue
+                discovered.add(name)
+                coro = gh.author_stats(repo['owner'], repo['name'], user)
+                await queue.put(asyncio.ensure_future(coro))
+
+        async def produce():
+            # current window changes every hour, it's requested on its
+            # own to keep requests for past windows cacheable
+            windows = list(contribution_windows(since, until))
+            batches = chunks(windows[:-1], CONTRIBUTIONS_BATCH)
+            if windows:
+                batches.append(windows[-1:])
+            tasks = [asyncio.ensure_future(discover(batch))
+                     for batch in batches]
             try:
-                owner, repo, contributions = await task
-            except RuntimeError as e:
-                logging.exception('failed to get contributions: %s', e)
-            else:
-                stats = [c for c in contributions
-                         if c['author']['login'] == username]
-                if stats:
-                    repo_stats = {
-                        'repo': {
-                            'owner': owner,
-                            'name': repo,
-                        },
-                        'stats': stats[0]
-                    }
-                    user_stats.append(repo_stats)
-        return user_stats
+                await asyncio.gather(*tasks)
+            finally:
+                # stop the rest of discovery if one of the batches failed
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await queue.put(None)
+
+        producer = asyncio.ensure_future(produce())
+        pbar = progress_bar(pbar_enabled)
+        processed = 0
+        # tasks are consumed in completion order, but no more than window
+        # of them are taken from the queue to keep discovery bounded
+        window = max_concurrency * 2
+        pending = set()
+        getter = None
+        discovering = True
+        try:
+            while discovering or pending:
+                if discovering and not getter and len(pending) < window:
+                    getter = asyncio.ensure_future(queue.get())
+                waiting = pending | {getter} if getter else pending
+                done, _ = await asyncio.wait(
+                    waiting, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is getter:
+                        getter = None
+                        if task.result() is None:
+                            discovering = False
+                        else:
+                            pending.add(task.result())
+                        continue
+
+                    pending.remove(task)
+                    try:
+                        owner, repo, stats = task.result()
+                    except (RuntimeError, httpx.HTTPError) as e:
+                        logging.exception('failed to get contributions: %s',
+                                          e)
+                    else:
+                        if stats:
+                            yield {
+                                'repo': {
+                                    'owner': owner,
+                                    'name': repo,
+                                },
+                                'stats': stats
+                            }
+                    processed += 1
+                    pbar.update(processed)
+            pbar.finish()
+            # re-raise discovery errors, if any
+            await producer
+        finally:
+            # nothing is left running (or unretrieved) once the client
+            # is closed, whether listing completed or failed halfway
+            leftovers = [producer, *pending, *drain_queue(queue)]
+            if getter and getter.done() and not getter.cancelled():
+                leftovers.extend(filter(None, [getter.result()]))
+            elif getter:
+                leftovers.append(getter)
+            for task in leftovers:
+                task.cancel()
+            await asyncio.gather(*leftovers, return_exceptions=True)
+            # discovery may have queued more before it was cancelled
+            late = drain_queue(queue)
+            for task in late:
+                task.cancel()
+            await asyncio.gather(*late, return_exceptions=True)
+
+
+async def dump_contributions(contributions, out):
+    # same layout as json.dump(..., indent=2), but written item by item
+    separator = '\n'
+    out.write('[')
+    try:
+        async for contribution in contributions:
+            item = orjson.dumps(contribution, option=orjson.OPT_INDENT_2)
+            out.write(separator + textwrap.indent(item.decode(), ' ' * 2))
+            separator = ',\n'
+    finally:
+        # output stays valid JSON with whatever was listed before a failure
+        out.write('\n]' if separator != '\n' else ']')
+        await contributions.aclose()
 
 
 def user_contributions(gh_token, gh_url, username, owners, max_concurrency,
-                       max_contributions, pbar_enabled):
+                       pbar_enabled, cache_path, out):
     loop = asyncio.get_event_loop()
-    coro = list_contributions(gh_token, gh_url, username, owners,
-                              max_concurrency, max_contributions, pbar_enabled)
+    contributions = list_contributions(gh_token, gh_url, username, owners,
+                                       max_concurrency, pbar_enabled,
+                                       cache_path)
+    coro = dump_contributions(contributions, out)
     task = asyncio.ensure_future(coro, loop=loop)
     try:
         loop.run_until_complete(task)
@@ -304,12 +694,12 @@ def main():
     if pbar_enabled:
         progressbar.streams.wrap_stderr()
     setup_logging(args.verbose)
+    if uvloop:
+        uvloop.install()
 
-    contrs = user_contributions(gh_token, args.url, args.username, args.owners,
-                                args.max_concurrency,
-                                args.max_contributors,
-                                pbar_enabled)
-    json.dump(contrs, args.out, indent=4)
+    user_contributions(gh_token, args.url, args.username, args.owners,
+                       args.max_concurrency, pbar_enabled, args.cache,
+                       args.out)
 
 
 if __name__ == '__main__':